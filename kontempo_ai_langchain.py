@@ -1,20 +1,83 @@
 # kontempo_ai_langchain.py
 import os
+import asyncio
+import logging
+import hashlib
+import functools
+import heapq
+import time
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
 from langchain_core.runnables import RunnableLambda
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.callbacks import BaseCallbackHandler
 from langserve import add_routes
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
 import uvicorn
-from typing import List, Dict
-import json
+import httpx
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from openai import RateLimitError
+import redis.asyncio as aioredis
+from cachetools import TTLCache
+from pydantic import BaseModel, Field, ValidationInfo, field_validator
+from typing import Any, Callable, List, Dict, Optional, Tuple, Union
+import orjson
+from collections import defaultdict
+from operator import attrgetter
 
 # Configuración
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Clave de enrutamiento para el prompt caching automático de OpenAI
+# (subir la versión cuando cambie SYSTEM_PROMPT)
+PROMPT_CACHE_KEY = os.getenv("PROMPT_CACHE_KEY", "kontempo-sys-v2")
+
+# Orígenes permitidos por CORS (separados por coma)
+FRONTEND_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("FRONTEND_ORIGIN", "https://app.kontempo.com").split(",")
+    if origin.strip()
+]
+
+# Cache de respuestas del LLM (Redis si REDIS_URL está definido)
+REDIS_URL = os.getenv("REDIS_URL")
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 300))
+
+# Máximo de clientes listados por status en el resumen enviado al LLM
+SUMMARY_TOPK = int(os.getenv("SUMMARY_TOPK", 10))
+
+# Máximo de mensajes previos del historial que se envían al LLM
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", 10))
+
+# A partir de este número de buyers el resumen se calcula en un thread
+LARGE_MERCHANT_THRESHOLD = 200
+
+# Agrupar tokens del streaming: enviar cada N chunks o cada N segundos
+STREAM_FLUSH_CHUNKS = 32
+STREAM_FLUSH_SECONDS = 0.05
+
+# Límites de requests y tokens por minuto de la cuenta de OpenAI (para todo
+# el servicio); cada worker recibe una parte igual
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", 3500))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", 200000))
+
+# Tiempo máximo del precalentamiento al arrancar (muy por debajo del
+# --timeout de 30 s de Gunicorn)
+WARMUP_TIMEOUT_SECONDS = 5
+
+# Workers del servidor (mismo valor que usa el Procfile)
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", 4)))
+
+# Solo el logger de la app va a INFO; el root (httpx, gunicorn) no se toca
+logger = logging.getLogger("kontempo_ai")
+logger.setLevel(logging.INFO)
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    logger.addHandler(_log_handler)
 
 # Sistema de prompt
 SYSTEM_PROMPT = """Eres un asistente especializado para usuarios del dashboard de Kontempo.
@@ -68,99 +131,277 @@ Cuando te pidan listar clientes por status, organiza así:
 
 **RECHAZADOS (X):**
 - Nombre Cliente 4
-"""
+""".strip()
 
-def summarize_merchant_data(data: Dict) -> str:
-    try:
-        buyers = data.get('buyers', [])
-        
-        # Agrupar clientes por status
-        status_groups = {}
-        for buyer in buyers:
-            status = buyer.get('approval_status', 'unknown')
-            if status not in status_groups:
-                status_groups[status] = []
-            status_groups[status].append({
-                'name': buyer.get('display_name', 'Sin nombre'),
-                'email': buyer.get('email', ''),
-                'credit_limit': buyer.get('credit', {}).get('credit_limit', 0)
-            })
-
-        summary = f"""
+# Modelos del request: Pydantic valida y parsea el JSON una sola vez
+class RequestModel(BaseModel):
+    """Base de los modelos del request: un campo en null toma su valor por
+    defecto, para que un registro incompleto no rechace todo el request"""
+
+    @field_validator("*", mode="before")
+    @classmethod
+    def null_as_default(cls, value: Any, info: ValidationInfo) -> Any:
+        if value is None:
+            return cls.model_fields[info.field_name].get_default(call_default_factory=True)
+        return value
+
+class Credit(RequestModel):
+    credit_limit: Optional[float] = 0
+    credit_used: Optional[float] = 0
+
+class Buyer(RequestModel):
+    display_name: Optional[str] = "Sin nombre"
+    approval_status: Optional[str] = "unknown"
+    credit: Optional[Credit] = Field(default_factory=Credit)
+
+class Payout(RequestModel):
+    amount: Optional[float] = 0
+
+class MerchantContext(RequestModel):
+    buyers: Optional[List[Buyer]] = []
+    orders: Optional[List[Dict]] = []
+    payouts: Optional[List[Payout]] = []
+    payment_links: Optional[List[Dict]] = []
+
+class Msg(RequestModel):
+    role: Optional[str] = ""
+    content: Optional[str] = ""
+
+class UserCtx(RequestModel):
+    role: Optional[str] = "admin"
+
+class ChatRequest(RequestModel):
+    query: Optional[str] = ""
+    context: Optional[MerchantContext] = Field(default_factory=MerchantContext)
+    user: Optional[UserCtx] = Field(default_factory=UserCtx)
+    conversation_history: Optional[List[Msg]] = []
+    stream: Optional[bool] = False
+
+class TestRequest(BaseModel):
+    query: str = "¿Cómo va mi programa de crédito?"
+    role: str = "admin"
+    conversation_history: List[Msg] = []
+    stream: bool = False
+
+class KontempoChainInput(BaseModel):
+    """Input del chain expuesto por LangServe (ya procesado)"""
+    query: str
+    merchant_summary: str
+    user_role: str = "admin"
+    chat_history: List[Union[HumanMessage, AIMessage]] = []
+
+# Nombre en español de cada approval_status
+_STATUS_ES = {
+    'active': 'ACTIVOS',
+    'pending': 'PENDIENTES',
+    'rejected': 'RECHAZADOS',
+    'suspended': 'SUSPENDIDOS'
+}
+
+# Getters precompilados (C) para leer campos sin lambdas por registro
+_AMOUNT = attrgetter('amount')
+_BUYER_FIELDS = attrgetter('approval_status', 'display_name', 'credit.credit_limit')
+
+# Resumen fijo para merchants sin buyers, órdenes ni payouts (p. ej. en onboarding)
+_EMPTY_SUMMARY = "\nRESUMEN DEL PROGRAMA DE CRÉDITO:\n\n(Sin datos aún)\n"
+
+def group_buyers_by_status(buyers: List[Buyer]) -> Dict[str, Tuple[List[str], List[float]]]:
+    """Agrupa buyers por approval_status en listas paralelas
+    (nombres, límites de crédito)"""
+    status_groups = defaultdict(lambda: ([], []))
+    for status, name, credit_limit in map(_BUYER_FIELDS, buyers):
+        names, limits = status_groups[status]
+        names.append(name)
+        limits.append(credit_limit)
+    return status_groups
+
+def summarize_merchant_data(data: MerchantContext) -> str:
+    buyers = data.buyers
+    orders = data.orders
+    payouts = data.payouts
+    if not (buyers or orders or payouts):
+        return _EMPTY_SUMMARY
+    
+    # Agrupar clientes por status en una sola pasada
+    status_groups = group_buyers_by_status(buyers)
+
+    # Acumular en una lista y unir al final (evita concatenaciones O(n²))
+    parts = ["""
 RESUMEN DEL PROGRAMA DE CRÉDITO:
 
 CLIENTES POR STATUS DE APROBACIÓN:
-"""
-        
-        for status, clients in status_groups.items():
-            status_name = {
-                'active': 'ACTIVOS',
-                'pending': 'PENDIENTES', 
-                'rejected': 'RECHAZADOS',
-                'suspended': 'SUSPENDIDOS'
-            }.get(status, status.upper())
-            
-            summary += f"{status_name} ({len(clients)}):\n"
-            for client in clients:
-                summary += f"  • {client['name']}\n"
-            summary += "\n"
-        
-        # Resto de métricas...
-        orders = data.get('orders', [])
-        payouts = data.get('payouts', [])
+"""]
+    
+    for status, (names, limits) in status_groups.items():
+        status_name = _STATUS_ES.get(status) or status.upper()
         
-        total_revenue = sum(p.get('amount', 0) for p in payouts)
-        summary += f"""
+        parts.append(f"{status_name} ({len(names)}):\n")
+        # Listar solo los clientes con mayor límite de crédito
+        top = heapq.nlargest(SUMMARY_TOPK, range(len(names)), key=limits.__getitem__)
+        parts.extend(f"  • {names[i]}\n" for i in top)
+        if len(names) > SUMMARY_TOPK:
+            parts.append(f"  • ...y {len(names) - SUMMARY_TOPK} clientes más\n")
+        parts.append("\n")
+    
+    # Resto de métricas...
+    total_revenue = sum(map(_AMOUNT, payouts))
+    parts.append(f"""
 MÉTRICAS GENERALES:
 - Total clientes: {len(buyers)}
 - Ingresos totales: ${total_revenue:,.2f}
 - Órdenes procesadas: {len(orders)}
-"""
-        
-        return summary
+""")
+    
+    return "".join(parts)
 
-    except Exception as e:
-        return f"Error procesando datos: {str(e)}"
+class CacheUsageLogger(BaseCallbackHandler):
+    """Registra cuántos tokens del prompt se sirvieron desde el cache de OpenAI"""
+    run_inline = True
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if not usage:
+                    continue
+                cached = usage.get("input_token_details", {}).get("cache_read", 0)
+                logger.info(
+                    "prompt_tokens=%s cached_tokens=%s",
+                    usage.get("input_tokens", 0),
+                    cached,
+                )
+
+# Cliente HTTP compartido por todas las llamadas a OpenAI (pool de conexiones);
+# HTTP/2 multiplexa los requests concurrentes sobre una misma conexión TLS
+http_async_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+)
+
+class RateLimiter:
+    """Token bucket de requests y tokens por minuto: espera capacidad antes de
+    llamar a OpenAI en vez de reintentar después de un 429"""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.req_cap = float(rpm)
+        self.tok_cap = float(tpm)
+        self.last_update = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.req_cap = min(self.rpm, self.req_cap + elapsed * self.rpm / 60)
+        self.tok_cap = min(self.tpm, self.tok_cap + elapsed * self.tpm / 60)
+        self.last_update = now
+
+    async def acquire(self, tokens: int):
+        tokens = min(tokens, self.tpm)
+        while True:
+            self._refill()
+            if self.req_cap >= 1 and self.tok_cap >= tokens:
+                self.req_cap -= 1
+                self.tok_cap -= tokens
+                return
+            # Dormir justo lo necesario para recuperar la capacidad faltante
+            await asyncio.sleep(max(
+                (1 - self.req_cap) * 60 / self.rpm,
+                (tokens - self.tok_cap) * 60 / self.tpm,
+            ))
 
-# Crear el chain de LangChain
+# Throttling de llamadas al LLM: cada worker usa su parte de los límites de
+# la cuenta, para que la suma de todos no pase del límite de OpenAI
+rate_limiter = RateLimiter(
+    max(1, OPENAI_RPM // WEB_CONCURRENCY),
+    max(1, OPENAI_TPM // WEB_CONCURRENCY),
+)
+
+# Modelo: una sola instancia por proceso, reutilizada por todos los requests
+llm = ChatOpenAI(
+    model="gpt-4o-mini",
+    temperature=0.3,
+    api_key=OPENAI_API_KEY,
+    timeout=30,
+    # Sin reintentos internos del SDK: los 429 los reintenta invoke_chain
+    # pasando por el rate limiter
+    max_retries=0,
+    http_async_client=http_async_client,
+    # Incluir usage (y cached_tokens) también en respuestas por streaming
+    stream_usage=True,
+    extra_body={"prompt_cache_key": PROMPT_CACHE_KEY},
+    callbacks=[CacheUsageLogger()],
+)
+
+# Mensaje de sistema estático: se construye una sola vez, sin pasar por el
+# formateo de templates en cada request
+SYSTEM_MESSAGE = SystemMessage(content=SYSTEM_PROMPT)
+
+# Templates dinámicos, ordenados de más estable a más volátil para maximizar el
+# prefijo cacheado por OpenAI: el contexto del merchant se repite en todos los
+# turnos de una sesión, el historial crece y la pregunta cambia en cada turno
+CONTEXT_TEMPLATE = "ROL DEL USUARIO: {user_role}\n\nDATOS DEL MERCHANT:\n{merchant_summary}"
+QUESTION_TEMPLATE = "PREGUNTA DEL USUARIO: {query}"
+
+def build_messages(variables: Dict) -> List:
+    """Arma los mensajes para el LLM (system, contexto, historial y pregunta
+    actual); solo se formatea la parte dinámica"""
+    return [
+        SYSTEM_MESSAGE,
+        # El rol y los datos del merchant vienen del request (nombres escritos
+        # por terceros): van en un mensaje de usuario, nunca con rango de system
+        HumanMessage(content=CONTEXT_TEMPLATE.format(
+            user_role=variables["user_role"],
+            merchant_summary=variables["merchant_summary"],
+        )),
+        *variables.get("chat_history", ()),
+        HumanMessage(content=QUESTION_TEMPLATE.format(query=variables["query"])),
+    ]
+
+# Crear el chain de LangChain (cacheado: siempre devuelve el mismo chain)
+@functools.lru_cache(maxsize=1)
 def create_kontempo_chain():
-    # Modelo
-    llm = ChatOpenAI(
-        model="gpt-4o-mini",
-        temperature=0.3,
-        api_key=OPENAI_API_KEY
-    )
-    
-    # Template del prompt simplificado
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", SYSTEM_PROMPT),
-        ("human", "ROL DEL USUARIO: {user_role}\n\nDATOS DEL MERCHANT:\n{merchant_summary}\n\nPREGUNTA DEL USUARIO: {query}")
-    ])
-    
     # Chain
-    chain = prompt | llm | StrOutputParser()
+    chain = RunnableLambda(build_messages) | llm | StrOutputParser()
     
     return chain
 
+# Crear el chain una sola vez al importar el módulo
+kontempo_chain = create_kontempo_chain()
+
+# Métodos del chain ligados de antemano para el hot path de los endpoints
+_ainvoke = kontempo_chain.ainvoke
+_astream = kontempo_chain.astream
+
+async def get_merchant_summary(merchant_data: MerchantContext) -> str:
+    """Calcula el resumen; con muchos buyers se calcula en un thread para no
+    bloquear el event loop"""
+    if len(merchant_data.buyers) < LARGE_MERCHANT_THRESHOLD:
+        return summarize_merchant_data(merchant_data)
+    return await asyncio.to_thread(summarize_merchant_data, merchant_data)
+
+# Clase de mensaje de LangChain según el rol del historial
+_ROLE = {"user": HumanMessage, "assistant": AIMessage}
+
 # Función para procesar input
-def process_input(input_data: Dict) -> Dict:
+async def process_input(input_data: ChatRequest) -> Dict:
     """Procesa el input y prepara el contexto"""
-    query = input_data.get("query", "")
-    merchant_data = input_data.get("context", {})
-    user_context = input_data.get("user", {})
-    conversation_history = input_data.get("conversation_history", [])
+    query = input_data.query
+    merchant_data = input_data.context
+    conversation_history = input_data.conversation_history
     
-    # Convertir historial a mensajes de LangChain
-    chat_history = []
-    for msg in conversation_history[:-1]:  # Excluir el mensaje actual
-        if msg["role"] == "user":
-            chat_history.append(HumanMessage(content=msg["content"]))
-        elif msg["role"] == "assistant":
-            chat_history.append(AIMessage(content=msg["content"]))
+    # Convertir historial a mensajes de LangChain, excluyendo el mensaje actual
+    # y conservando solo los HISTORY_MAX_MESSAGES más recientes
+    chat_history = [
+        _ROLE[msg.role](content=msg.content)
+        for msg in conversation_history[-HISTORY_MAX_MESSAGES - 1:-1]
+        if msg.role in _ROLE
+    ]
     
     # Preparar contexto
-    merchant_summary = summarize_merchant_data(merchant_data)
-    user_role = user_context.get("role", "admin")
+    merchant_summary = await get_merchant_summary(merchant_data)
+    user_role = input_data.user.role
     
     return {
         "query": query,
@@ -169,46 +410,150 @@ def process_input(input_data: Dict) -> Dict:
         "user_role": user_role
     }
 
+# Cache de respuestas: Redis compartido entre procesos, o en memoria como fallback
+redis_client = aioredis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+local_response_cache = TTLCache(maxsize=1024, ttl=RESPONSE_CACHE_TTL)
+
+def response_cache_key(processed_input: Dict) -> Optional[str]:
+    """Clave exacta por (rol, pregunta, resumen). Solo se cachean sesiones nuevas:
+    con historial la respuesta depende de la conversación y devuelve None"""
+    if processed_input["chat_history"]:
+        return None
+    raw = orjson.dumps((
+        processed_input["user_role"],
+        processed_input["query"],
+        processed_input["merchant_summary"],
+    ))
+    return "kontempo:response:" + hashlib.sha256(raw).hexdigest()
+
+async def get_cached_response(key: Optional[str]):
+    if key is None:
+        return None
+    if redis_client is None:
+        return local_response_cache.get(key)
+    try:
+        return await redis_client.get(key)
+    except Exception as e:
+        logger.warning("Error leyendo cache de respuestas: %s", e)
+        return None
+
+async def set_cached_response(key: Optional[str], response: str):
+    if key is None:
+        return
+    if redis_client is None:
+        local_response_cache[key] = response
+        return
+    try:
+        await redis_client.setex(key, RESPONSE_CACHE_TTL, response)
+    except Exception as e:
+        logger.warning("Error guardando cache de respuestas: %s", e)
+
+def estimate_tokens(processed_input: Dict) -> int:
+    """Estimación barata de tokens del prompt (~4 caracteres por token)"""
+    chars = (
+        len(SYSTEM_PROMPT)
+        + len(CONTEXT_TEMPLATE)
+        + len(QUESTION_TEMPLATE)
+        + len(processed_input["merchant_summary"])
+        + len(processed_input["query"])
+        + sum(len(msg.content) for msg in processed_input["chat_history"])
+    )
+    return chars // 4
+
+async def invoke_chain(processed_input: Dict) -> str:
+    """Ejecuta el chain respetando el rate limit, con backoff exponencial ante 429"""
+    tokens = estimate_tokens(processed_input)
+    async for attempt in AsyncRetrying(
+        retry=retry_if_exception_type(RateLimitError),
+        wait=wait_random_exponential(multiplier=1, max=60),
+        stop=stop_after_attempt(6),
+        reraise=True,
+    ):
+        with attempt:
+            await rate_limiter.acquire(tokens)
+            response = await _ainvoke(processed_input)
+    return response
+
+class ORJSONRequest(Request):
+    """Request que parsea el body JSON con orjson en vez de json"""
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+class ORJSONRoute(APIRoute):
+    """Ruta que entrega un ORJSONRequest a FastAPI para parsear el body"""
+    def get_route_handler(self) -> Callable:
+        original_route_handler = super().get_route_handler()
+
+        async def orjson_route_handler(request: Request) -> Response:
+            return await original_route_handler(ORJSONRequest(request.scope, request.receive))
+
+        return orjson_route_handler
+
 # Crear la app FastAPI
 app = FastAPI(
     title="Kontempo AI with LangChain",
     version="1.0",
     description="AI Assistant for Kontempo merchants using LangChain",
+    default_response_class=ORJSONResponse,
 )
+app.router.route_class = ORJSONRoute
 
-app = FastAPI(title="Kontempo AI", description="AI Assistant for Kontempo merchants")
+@app.on_event("startup")
+async def warm_openai_pool():
+    """Abre la conexión con OpenAI antes del primer request real; con tiempo
+    acotado, porque el worker no reporta heartbeat a Gunicorn hasta terminar
+    el startup"""
+    try:
+        await asyncio.wait_for(
+            llm.bind(max_tokens=1).ainvoke("ping"),
+            timeout=WARMUP_TIMEOUT_SECONDS,
+        )
+    except Exception as e:
+        logger.warning("No se pudo precalentar la conexión con OpenAI: %r", e)
+
+@app.on_event("shutdown")
+async def close_openai_pool():
+    """Cierra las conexiones abiertas con OpenAI"""
+    await http_async_client.aclose()
 
 # Agregar CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # En producción, especifica dominios específicos
+    allow_origins=FRONTEND_ORIGINS,
     allow_credentials=True,
     allow_methods=["GET", "POST"],
-    allow_headers=["*"],
+    allow_headers=["content-type", "authorization"],
+    # Los navegadores cachean el preflight por un día
+    max_age=86400,
 )
 
-# Crear el chain
-kontempo_chain = create_kontempo_chain()
-
 # Agregar rutas con LangServe
 add_routes(
     app,
     kontempo_chain,
     path="/kontempo",
-    input_type=Dict,
+    input_type=KontempoChainInput,
     playground_type="chat",
 )
 
-# Endpoint personalizado compatible con tu frontend actual
-@app.post("/chat")
-async def chat_endpoint(request_data: Dict):
+async def prepare_chat(request_data: ChatRequest) -> Tuple[Dict, Optional[str], Optional[str]]:
+    """Procesa el input y busca una respuesta cacheada"""
+    processed_input = await process_input(request_data)
+    cache_key = response_cache_key(processed_input)
+    return processed_input, cache_key, await get_cached_response(cache_key)
+
+async def complete_chat(request_data: ChatRequest) -> Dict:
+    """Ejecuta una consulta completa (sin streaming) y arma la respuesta JSON"""
     try:
-        # Procesar input
-        processed_input = process_input(request_data)
-        
-        # Ejecutar chain
-        response = await kontempo_chain.ainvoke(processed_input)
-        
+        processed_input, cache_key, response = await prepare_chat(request_data)
+
+        # Ejecutar chain (solo si no hay respuesta cacheada)
+        if response is None:
+            response = await invoke_chain(processed_input)
+            await set_cached_response(cache_key, response)
+
         return {
             "response": response,
             "merchant_summary": processed_input["merchant_summary"],
@@ -222,124 +567,213 @@ async def chat_endpoint(request_data: Dict):
             "status": "error"
         }
 
+# Endpoint personalizado compatible con tu frontend actual: responde JSON
+# completo, salvo que el cliente pida "stream": true
+@app.post("/chat")
+async def chat_endpoint(request_data: ChatRequest):
+    if request_data.stream:
+        return await chat_stream_endpoint(request_data)
+
+    return ORJSONResponse(await complete_chat(request_data))
+
+# Streaming (SSE): enviar tokens conforme llegan
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request_data: ChatRequest):
+    try:
+        processed_input, cache_key, cached_response = await prepare_chat(request_data)
+    except Exception as e:
+        return ORJSONResponse({
+            "error": str(e),
+            "status": "error"
+        })
+
+    return StreamingResponse(
+        stream_chat(processed_input, cache_key, cached_response),
+        media_type="text/event-stream",
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"},
+    )
+
+# Fin del stream SSE
+SSE_DONE = b"data: [DONE]\n\n"
+
+def sse_event(payload: Dict) -> bytes:
+    """Formatea un payload como evento SSE (serializado con orjson)"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+async def stream_chat(processed_input: Dict, cache_key: Optional[str], cached_response=None):
+    """Genera eventos SSE con los tokens del chain, agrupados en lotes"""
+    if cached_response is not None:
+        yield sse_event({'token': cached_response})
+        yield SSE_DONE
+        return
+
+    chunks = []
+    pending = 0  # chunks recibidos que aún no se han enviado
+    try:
+        await rate_limiter.acquire(estimate_tokens(processed_input))
+        last_flush = time.monotonic()
+        async for chunk in _astream(processed_input):
+            if not chunk:  # el primer y último chunk de OpenAI suelen venir vacíos
+                continue
+            chunks.append(chunk)
+            pending += 1
+            now = time.monotonic()
+            if pending >= STREAM_FLUSH_CHUNKS or now - last_flush >= STREAM_FLUSH_SECONDS:
+                yield sse_event({'token': "".join(chunks[-pending:])})
+                pending = 0
+                last_flush = now
+        if pending:
+            yield sse_event({'token': "".join(chunks[-pending:])})
+        await set_cached_response(cache_key, "".join(chunks))
+    except Exception as e:
+        if pending:
+            yield sse_event({'token': "".join(chunks[-pending:])})
+        yield sse_event({'error': str(e), 'status': 'error'})
+    yield SSE_DONE
+
+@app.post("/chat/batch")
+async def chat_batch_endpoint(requests_data: List[ChatRequest]):
+    # Resolver todas las consultas en paralelo (sin streaming)
+    return ORJSONResponse(await asyncio.gather(
+        *(complete_chat(request_data) for request_data in requests_data)
+    ))
+
+# Contexto mock para testing: se valida una sola vez al importar y se
+# comparte (sin copiar) entre requests
+_MOCK_CONTEXT = MerchantContext.model_validate({
+    "buyers": [
+        {
+        "buyer_account": "buy_1234567890.1111",
+        "display_name": "TECH INNOVATIONS SA DE CV",
+        "email": "compras@techinnovations.mx",
+        "approval_status": "active",
+        "credit": {
+            "credit_limit": 120000,
+            "credit_used": 95000
+        }
+        },
+        {
+        "buyer_account": "buy_2345678901.2222",
+        "display_name": "Materiales Industriales del Norte",
+        "email": "pedidos@materiales-norte.com",
+        "approval_status": "active",
+        "credit": {
+            "credit_limit": 80000,
+            "credit_used": 55000
+        }
+        },
+        {
+        "buyer_account": "buy_3456789012.3333",
+        "display_name": "CONSTRUCTORA MODERNA LTDA",
+        "email": "admin@construmoderna.mx",
+        "approval_status": "pending",
+        "credit": {
+            "credit_limit": 0,
+            "credit_used": 0
+        }
+        },
+        {
+        "buyer_account": "buy_4567890123.4444",
+        "display_name": "Distribuidora ABC",
+        "email": "ventas@distribuidora-abc.com",
+        "approval_status": "rejected",
+        "credit": {
+            "credit_limit": 0,
+            "credit_used": 0
+        }
+        }
+    ],
+    "orders": [
+        {
+        "buyer_account": "buy_1234567890.1111",
+        "amount": 45000,
+        "payment_status": "completed_on_time",
+        "created": 1734659051,
+        "external_order_id": "ORD-001"
+        },
+        {
+        "buyer_account": "buy_2345678901.2222", 
+        "amount": 35000,
+        "payment_status": "completed_late",
+        "created": 1736285243,
+        "external_order_id": "ORD-002"
+        },
+        {
+        "buyer_account": "buy_1234567890.1111",
+        "amount": 50000,
+        "payment_status": "due",
+        "created": 1737384627,
+        "external_order_id": "ORD-003"
+        }
+    ],
+    "payouts": [
+        {
+        "amount": 43650,
+        "payout_date": 1738866140,
+        "currency": "MXN",
+        "status": "completed"
+        },
+        {
+        "amount": 34300,
+        "payout_date": 1739212444,
+        "currency": "MXN", 
+        "status": "completed"
+        },
+        {
+        "amount": 49000,
+        "payout_date": 1739816995,
+        "currency": "MXN",
+        "status": "pending"
+        }
+    ],
+    "payment_links": [
+        {
+        "buyer_account": "buy_1234567890.1111",
+        "cart_total": 50000,
+        "expires": 1740700800,
+        "external_order_id": "ORD-003",
+        "description": "Materiales de construcción",
+        "status": 0,
+        "created": 1737395614
+        },
+        {
+        "buyer_account": "buy_2345678901.2222",
+        "cart_total": 25000,
+        "expires": 1741305600,
+        "external_order_id": "ORD-004", 
+        "description": "Equipos industriales",
+        "status": 0,
+        "created": 1737482000
+        }
+    ]
+    })
+
 @app.post("/test")
-async def test_endpoint(request_data: Dict):
-    # Datos mock para testing
-    mock_data = {
-        "query": request_data.get("query", "¿Cómo va mi programa de crédito?"),
-        "context": {
-            "buyers": [
-                {
-                "buyer_account": "buy_1234567890.1111",
-                "display_name": "TECH INNOVATIONS SA DE CV",
-                "email": "compras@techinnovations.mx",
-                "approval_status": "active",
-                "credit": {
-                    "credit_limit": 120000,
-                    "credit_used": 95000
-                }
-                },
-                {
-                "buyer_account": "buy_2345678901.2222",
-                "display_name": "Materiales Industriales del Norte",
-                "email": "pedidos@materiales-norte.com",
-                "approval_status": "active",
-                "credit": {
-                    "credit_limit": 80000,
-                    "credit_used": 55000
-                }
-                },
-                {
-                "buyer_account": "buy_3456789012.3333",
-                "display_name": "CONSTRUCTORA MODERNA LTDA",
-                "email": "admin@construmoderna.mx",
-                "approval_status": "pending",
-                "credit": {
-                    "credit_limit": 0,
-                    "credit_used": 0
-                }
-                },
-                {
-                "buyer_account": "buy_4567890123.4444",
-                "display_name": "Distribuidora ABC",
-                "email": "ventas@distribuidora-abc.com",
-                "approval_status": "rejected",
-                "credit": {
-                    "credit_limit": 0,
-                    "credit_used": 0
-                }
-                }
-            ],
-            "orders": [
-                {
-                "buyer_account": "buy_1234567890.1111",
-                "amount": 45000,
-                "payment_status": "completed_on_time",
-                "created": 1734659051,
-                "external_order_id": "ORD-001"
-                },
-                {
-                "buyer_account": "buy_2345678901.2222", 
-                "amount": 35000,
-                "payment_status": "completed_late",
-                "created": 1736285243,
-                "external_order_id": "ORD-002"
-                },
-                {
-                "buyer_account": "buy_1234567890.1111",
-                "amount": 50000,
-                "payment_status": "due",
-                "created": 1737384627,
-                "external_order_id": "ORD-003"
-                }
-            ],
-            "payouts": [
-                {
-                "amount": 43650,
-                "payout_date": 1738866140,
-                "currency": "MXN",
-                "status": "completed"
-                },
-                {
-                "amount": 34300,
-                "payout_date": 1739212444,
-                "currency": "MXN", 
-                "status": "completed"
-                },
-                {
-                "amount": 49000,
-                "payout_date": 1739816995,
-                "currency": "MXN",
-                "status": "pending"
-                }
-            ],
-            "payment_links": [
-                {
-                "buyer_account": "buy_1234567890.1111",
-                "cart_total": 50000,
-                "expires": 1740700800,
-                "external_order_id": "ORD-003",
-                "description": "Materiales de construcción",
-                "status": 0,
-                "created": 1737395614
-                },
-                {
-                "buyer_account": "buy_2345678901.2222",
-                "cart_total": 25000,
-                "expires": 1741305600,
-                "external_order_id": "ORD-004", 
-                "description": "Equipos industriales",
-                "status": 0,
-                "created": 1737482000
-                }
-            ]
-            },
-        "user": {"role": request_data.get("role", "admin")},
-        "conversation_history": request_data.get("conversation_history", [])
-    }
+async def test_endpoint(request_data: TestRequest):
+    mock_data = ChatRequest(
+        query=request_data.query,
+        context=_MOCK_CONTEXT,
+        user=UserCtx(role=request_data.role),
+        conversation_history=request_data.conversation_history,
+        stream=request_data.stream,
+    )
     
     return await chat_endpoint(mock_data)
 
+# Solo para desarrollo local; en producción el Procfile levanta Gunicorn con
+# workers de uvicorn
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Se pasa la app como import string para poder levantar varios workers;
+    # cada worker importa el módulo y crea su propio pool HTTP hacia OpenAI
+    uvicorn.run(
+        "kontempo_ai_langchain:app",
+        host="0.0.0.0",
+        port=port,
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
+        lifespan="on",
+        # Sin access log: evita formatear una línea de log por request
+        access_log=False,
+    )